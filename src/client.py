@@ -8,11 +8,20 @@ TCP чат-клиент.
 - Получает подтверждения о доставке
 """
 
+import os
+import sys
 import socket
-import threading
+import selectors
 import argparse
 
-from src.settings import ALLOWED_COMMANDS
+from src.protocol import RecvBuffer, pack_frame
+from src.settings import ALLOWED_COMMANDS, CONNECT_TIMEOUT, MAX_MESSAGE_SIZE
+
+# Команды, которые клиент выполняет сам, не отправляя на сервер
+EXIT_COMMANDS = frozenset((b'/exit', b'/quit'))
+HELP_COMMANDS = frozenset((b'/help',))
+# Строки длиннее самой длинной локальной команды сразу уходят на сервер
+LOCAL_COMMAND_MAX_SIZE = max(map(len, EXIT_COMMANDS | HELP_COMMANDS))
 
 
 class ChatClient:
@@ -20,65 +29,171 @@ class ChatClient:
         """Инициализация клиента"""
         self.host = host
         self.port = port
-        self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Сокет и буферы создаются заново при каждом подключении
+        self.client_socket = None
         self.running = False
         self.client_id = None
+        self.recv_buffer = None
+        # Незавершенная строка пользовательского ввода
+        self.input_buffer = b''
 
     def connect(self):
         """Подключение к серверу"""
         try:
-            print(f'Подключение к серверу {args.host}:{args.port}...')
-            self.client_socket.connect((self.host, self.port))
+            print(f'Подключение к серверу {self.host}:{self.port}...')
+            self.client_socket = self.open_socket()
+            self.recv_buffer = RecvBuffer()
+            self.input_buffer = b''
             self.running = True
 
-            # Получаем ID от сервера (первое сообщение)
-            self.client_id = int(self.client_socket.recv(1024).decode('utf-8'))
+            # Получаем ID от сервера (первое сообщение) или отказ в подключении
+            welcome = self.receive()
+            if welcome is None or not welcome.isdigit():
+                print(welcome or 'Соединение с сервером разорвано')
+                self.disconnect()
+                return
+
+            self.client_id = int(welcome)
             print(f'Подключено к серверу. Ваш ID: {self.client_id}')
             print('Доступные команды:', *ALLOWED_COMMANDS, sep='\n')
 
-            # Запуск потока для получения сообщений
-            threading.Thread(
-                target=self.receive_messages,
-                daemon=True
-            ).start()
-
-            self.send_messages()
-
-        except ConnectionRefusedError:
+        except OSError:
             print('Не удалось подключиться к серверу')
+            self.disconnect()
+            return
         except KeyboardInterrupt:
             self.disconnect()
-
-    def receive_messages(self):
-        """Получение сообщений от сервера"""
-        while self.running:
+            return
+
+        self.run()
+
+    def open_socket(self):
+        """Подключение к первому доступному адресу сервера (IPv4 или IPv6)"""
+        error = OSError(f'Адрес {self.host}:{self.port} не найден')
+        for family, sock_type, proto, _, address in socket.getaddrinfo(
+            self.host, self.port, type=socket.SOCK_STREAM
+        ):
+            sock = socket.socket(family, sock_type, proto)
+            sock.settimeout(CONNECT_TIMEOUT)
             try:
-                message = self.client_socket.recv(1024).decode('utf-8')
-                if not message:
-                    break
-                print(f'\n{message}\n>>> ', end='')
-            except ConnectionResetError:
-                break
+                sock.connect(address)
+            except OSError as exc:
+                sock.close()
+                error = exc
+                continue
 
-        print("\nСоединение с сервером разорвано")
-        self.running = False
+            sock.settimeout(None)
+            # Короткие сообщения чата отправляются сразу, без задержки Nagle
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            return sock
+
+        raise error
+
+    def run(self):
+        """Обработка ввода пользователя и сообщений сервера в одном потоке"""
+        selector = selectors.DefaultSelector()
+        selector.register(self.client_socket, selectors.EVENT_READ, self.receive_messages)
+        selector.register(sys.stdin, selectors.EVENT_READ, self.send_messages)
 
-    def send_messages(self):
-        """Отправка сообщений на сервер"""
         try:
+            print('>>> ', end='', flush=True)
+            # Кадры, пришедшие вместе с ID, уже лежат в буфере, и select о них не сообщит
+            self.print_messages()
             while self.running:
-                message = input('>>> ')
-                if message.lower() in ('/exit', '/quit'):
-                    break
-                elif message.lower() == '/help':
-                    print('Доступные команды:', *ALLOWED_COMMANDS, sep='\n')
-                else:
-                    self.client_socket.sendall(message.encode('utf-8'))
+                for key, _ in selector.select():
+                    if not self.running:
+                        break
+                    key.data()
         except KeyboardInterrupt:
             pass
         finally:
+            selector.close()
             self.disconnect()
 
+    def receive_messages(self):
+        """Получение сообщений, пришедших от сервера"""
+        try:
+            received = self.fill_buffer()
+        except ConnectionResetError:
+            received = 0
+
+        # Полностью принятые кадры выводятся и перед закрытием соединения
+        self.print_messages()
+        if not received:
+            print("\nСоединение с сервером разорвано")
+            self.running = False
+
+    def print_messages(self):
+        """Вывод всех сообщений, уже полностью принятых в буфер"""
+        while (message := self.read_frame()) is not None:
+            print(f'\n{message}\n>>> ', end='', flush=True)
+
+    def receive(self):
+        """Чтение очередного сообщения от сервера. Возвращает None при закрытии соединения"""
+        while True:
+            message = self.read_frame()
+            if message is not None:
+                return message
+            if not self.fill_buffer():
+                return None
+
+    def fill_buffer(self):
+        """Чтение данных из сокета в буфер приема. Возвращает число принятых байт"""
+        return self.recv_buffer.recv_from(self.client_socket)
+
+    def read_frame(self):
+        """Извлечение полного сообщения из буфера приема, если оно уже получено"""
+        payload = self.recv_buffer.next_frame()
+        if payload is None:
+            return None
+        # Сервер пересылает текст других клиентов без проверки кодировки
+        return str(payload, 'utf-8', 'replace')
+
+    def send_messages(self):
+        """Отправка на сервер строк, введенных пользователем"""
+        # Читаем напрямую из дескриптора: буферизованный readline может
+        # оставить строки в своем буфере, и select о них не узнает
+        data = os.read(sys.stdin.fileno(), 4096)
+        lines = (self.input_buffer + data).split(b'\n')
+        # Последний элемент -- незавершенная строка, если ввод не закончен
+        self.input_buffer = lines.pop() if data else b''
+
+        # Кадры всех строк, прочитанных за одно пробуждение,
+        # отправляются одним системным вызовом
+        frames = []
+        running = True
+        for line in lines:
+            if not self.handle_input(line.rstrip(), frames):
+                running = False
+                break
+
+        if frames:
+            self.client_socket.sendall(b''.join(frames))
+
+        if running and data:
+            print('>>> ', end='', flush=True)
+        else:
+            self.disconnect()
+
+    def handle_input(self, line, frames):
+        """
+        Обработка строки пользователя. Кадр для сервера добавляется в frames.
+        Возвращает False при завершении сеанса
+        """
+        if len(line) <= LOCAL_COMMAND_MAX_SIZE and line[:1] == b'/':
+            command = line.lower()
+            if command in EXIT_COMMANDS:
+                return False
+            if command in HELP_COMMANDS:
+                print('Доступные команды:', *ALLOWED_COMMANDS, sep='\n')
+                return True
+
+        if len(line) > MAX_MESSAGE_SIZE:
+            print(f'Сообщение длиннее {MAX_MESSAGE_SIZE} байт')
+        elif line:
+            frames.append(pack_frame(line))
+        return True
+
     def disconnect(self):
         """Отключение от сервера"""
         if self.running:
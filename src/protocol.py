@@ -0,0 +1,67 @@
+"""
+Формат кадров чат-протокола.
+
+Каждое сообщение передается кадром: 2 байта длины (big-endian),
+за которыми следует полезная нагрузка этой длины в байтах. Текст
+ожидается в UTF-8, но сервер его не проверяет: текст сообщений
+пересылается получателю как есть.
+"""
+
+import struct
+
+# Заголовок кадра с длиной полезной нагрузки
+HEADER = struct.Struct('!H')
+# Максимальный размер полезной нагрузки одного кадра
+MAX_PAYLOAD = 0xFFFF
+
+
+def pack_frame(payload):
+    """Упаковка данных в кадр с префиксом длины"""
+    return HEADER.pack(len(payload)) + payload
+
+
+class RecvBuffer:
+    """
+    Буфер приема кадров, переиспользуемый между вызовами recv_into.
+
+    Необработанные данные лежат в диапазоне [head, tail). Данные сдвигаются
+    в начало буфера, только когда прочитана его половина или место в конце
+    закончилось, поэтому большинство чтений обходится без копирования.
+    """
+
+    def __init__(self, size=HEADER.size + MAX_PAYLOAD):
+        """Инициализация буфера, вмещающего кадр максимального размера"""
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.head = 0
+        self.tail = 0
+
+    def recv_from(self, sock):
+        """Чтение из сокета в свободную часть буфера. Возвращает число принятых байт"""
+        if self.head == self.tail:
+            self.head = self.tail = 0
+        elif self.head > len(self.buffer) // 2 or self.tail == len(self.buffer):
+            size = self.tail - self.head
+            self.view[:size] = self.view[self.head:self.tail]
+            self.head, self.tail = 0, size
+
+        size = sock.recv_into(self.view[self.tail:])
+        self.tail += size
+        return size
+
+    def next_frame(self):
+        """
+        Полезная нагрузка следующего полного кадра или None, если кадр еще не получен.
+        Возвращаемый memoryview действителен до следующего вызова recv_from
+        """
+        available = self.tail - self.head
+        if available < HEADER.size:
+            return None
+
+        (size,) = HEADER.unpack_from(self.buffer, self.head)
+        if available < HEADER.size + size:
+            return None
+
+        start = self.head + HEADER.size
+        self.head = start + size
+        return self.view[start:self.head]
@@ -9,12 +9,41 @@ TCP чат-сервер с поддержкой нескольких клиен
 - Ведет логирование событий
 """
 
-import socket
-import threading
+import queue
+import asyncio
 import logging
-from queue import Queue
+from logging.handlers import QueueHandler, QueueListener
 
-from src.settings import ALLOWED_COMMANDS
+from src.protocol import HEADER, pack_frame
+from src.settings import (
+    ALLOWED_COMMANDS, LISTEN_BACKLOG, MAX_CLIENTS, MAX_MESSAGE_SIZE, MAX_SEND_BUFFER
+)
+
+
+class LogText:
+    """Байты из сети, которые декодируются только при форматировании записи лога"""
+
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        """Сохранение байтов без декодирования"""
+        self.data = data
+
+    def __str__(self):
+        """Текст для записи лога; некорректные последовательности UTF-8 заменяются"""
+        return self.data.decode('utf-8', 'replace')
+
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    QueueHandler, который кладет запись в очередь без форматирования.
+    Очередь не покидает процесс, поэтому сообщение собирается
+    и декодируется уже в потоке QueueListener
+    """
+
+    def prepare(self, record):
+        """Передача записи в очередь как есть"""
+        return record
 
 
 class ChatServer:
@@ -22,139 +51,236 @@ class ChatServer:
         """Инициализация сервера"""
         self.host = host
         self.port = port
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.clients = {}  # {client_id: (conn, addr)}
-        self.message_queues = {}  # {client_id: Queue}
+        self.server = None
+        # Все обработчики выполняются в одном event loop, поэтому
+        # словарь клиентов не требует блокировок
+        self.clients = {}  # {client_id: (writer, addr, encoded_id)}
         self.client_counter = 0
-        self.lock = threading.Lock()
 
-        # Настройка логирования
+        # Готовые кадры неизменяемых ответов сервера
+        self.bad_format_frame = self.encode_message(
+            'Ошибка: Неверный формат команды. Используйте /send <ID> <сообщение>'
+        )
+        self.unknown_command_frame = self.encode_message(
+            'Ошибка: Неизвестная команда. Список доступных команд:\n' + '\n'.join(ALLOWED_COMMANDS)
+        )
+        self.too_long_frame = self.encode_message(
+            f'Ошибка: Сообщение длиннее {MAX_MESSAGE_SIZE} байт'
+        )
+        self.server_full_frame = self.encode_message(
+            'Ошибка: Сервер переполнен, попробуйте подключиться позже'
+        )
+        # Закодированные заранее части ответов, в которые подставляются ID клиентов
+        self.message_prefix = 'Сообщение от '.encode('utf-8')
+        self.delivered_prefix = 'Сообщение доставлено клиенту '.encode('utf-8')
+        self.users_prefix = 'Список доступных пользователей: '.encode('utf-8')
+        # Кадр со списком пользователей; None -- список изменился и его нужно собрать заново
+        self.users_frame = None
+
+        # Настройка логирования: event loop только кладет записи в очередь,
+        # а форматирование и запись в файл выполняет фоновый поток QueueListener
+        log_queue = queue.SimpleQueue()
+        file_handler = logging.FileHandler('server.log', encoding='utf-8')
+        file_handler.setFormatter(
+            logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+        )
+        self.log_listener = QueueListener(log_queue, file_handler)
         logging.basicConfig(
-            filename='server.log',
             level=logging.INFO,
-            format='%(asctime)s - %(levelname)s - %(message)s',
-            encoding='utf-8'
+            handlers=[DeferredQueueHandler(log_queue)]
         )
 
-    def start(self):
+    async def start(self):
         """Запуск сервера"""
-        self.server_socket.bind((self.host, self.port))
-        self.server_socket.listen(5)
+        self.log_listener.start()
+
+        # TCP_NODELAY на принятых сокетах asyncio включает сам
+        self.server = await asyncio.start_server(
+            self.handle_client,
+            self.host,
+            self.port,
+            backlog=LISTEN_BACKLOG,
+            reuse_address=True
+        )
         logging.info(f'Сервер запущен на {self.host}:{self.port}')
         print(f'Сервер запущен на {self.host}:{self.port}')
 
         try:
-            while True:
-                conn, addr = self.server_socket.accept()
-                self.client_counter += 1
-                client_id = self.client_counter
-
-                with self.lock:
-                    self.clients[client_id] = (conn, addr)
-                    self.message_queues[client_id] = Queue()
-
-                logging.info(f'Новое подключение: {addr} (ID: {client_id})')
-                print(f'Новое подключение: {addr} (ID: {client_id})')
-
-                self.message_queues[client_id].put(
-                    str(client_id)
-                )
-
-                # Запуск потоков для клиента
-                threading.Thread(
-                    target=self.handle_client,
-                    args=(client_id,),
-                    daemon=True
-                ).start()
-
-                threading.Thread(
-                    target=self.send_messages,
-                    args=(client_id,),
-                    daemon=True
-                ).start()
-
-        except KeyboardInterrupt:
+            async with self.server:
+                await self.server.serve_forever()
+        finally:
             self.shutdown()
 
-    def handle_client(self, client_id):
+    async def handle_client(self, reader, writer):
         """Обработка входящих сообщений от клиента"""
-        conn, addr = self.clients[client_id]
+        addr = writer.get_extra_info('peername')
+        if len(self.clients) >= MAX_CLIENTS:
+            writer.write(self.server_full_frame)
+            writer.close()
+            logging.warning(f'Подключение {addr} отклонено: достигнут лимит в {MAX_CLIENTS} клиентов')
+            print(f'Подключение {addr} отклонено: достигнут лимит в {MAX_CLIENTS} клиентов')
+            return
+
+        self.client_counter += 1
+        client_id = self.client_counter
+        # ID кодируется один раз при подключении и хранится вместе с клиентом
+        encoded_id = str(client_id).encode('utf-8')
+        self.clients[client_id] = (writer, addr, encoded_id)
+        self.users_frame = None
+
+        logging.info(f'Новое подключение: {addr} (ID: {client_id})')
+        print(f'Новое подключение: {addr} (ID: {client_id})')
+
+        await self.send_frame(client_id, pack_frame(encoded_id))
 
         try:
             while True:
-                data = conn.recv(1024).decode('utf-8')
-                if not data:
+                payload = await self.receive_message(reader)
+                if payload is None:
                     break
 
-                logging.info(f'Получено от {addr} (ID: {client_id}): {data}')
+                if len(payload) > MAX_MESSAGE_SIZE:
+                    await self.send_frame(client_id, self.too_long_frame)
+                    continue
+
+                # Текст кадра декодируется только при форматировании записи
+                logging.info('Получено от %s (ID: %s): %s', addr, client_id, LogText(payload))
 
                 # Обработка сообщения
-                if data.startswith('/send'):
-                    parts = data.split(maxsplit=2)
+                if payload.startswith(b'/send'):
+                    parts = payload.split(maxsplit=2)
                     if len(parts) == 3 and parts[1].isdigit():
                         recipient_id = int(parts[1])
+                        # Текст сообщения пересылается как есть, без декодирования
                         message = parts[2]
-                        self.route_message(client_id, recipient_id, message)
+                        await self.route_message(client_id, recipient_id, message)
                     else:
-                        self.message_queues[client_id].put(
-                            'Ошибка: Неверный формат команды. Используйте /send <ID> <сообщение>'
-                        )
-                elif data.startswith('/users'):
-                    self.message_queues[client_id].put(
-                        'Список доступных пользователей: ' + ', '.join(str(x) for x in self.clients)
-                    )
+                        await self.send_frame(client_id, self.bad_format_frame)
+                elif payload.startswith(b'/users'):
+                    await self.send_frame(client_id, self.users_list_frame())
                 else:
-                    self.message_queues[client_id].put(
-                        'Ошибка: Неизвестная команда. Список доступных команд:\n' + '\n'.join(ALLOWED_COMMANDS)
-                    )
+                    await self.send_frame(client_id, self.unknown_command_frame)
 
         except ConnectionResetError:
             pass
         finally:
             self.disconnect_client(client_id)
 
-    def route_message(self, sender_id, recipient_id, message):
+    async def receive_message(self, reader):
+        """Чтение одного кадра от клиента. Возвращает None при закрытии соединения"""
+        try:
+            header = await reader.readexactly(HEADER.size)
+            (size,) = HEADER.unpack(header)
+            return await reader.readexactly(size)
+        except asyncio.IncompleteReadError:
+            return None
+
+    def users_list_frame(self):
+        """Кадр со списком пользователей, собираемый заново только после изменения списка"""
+        if self.users_frame is None:
+            self.users_frame = pack_frame(
+                self.users_prefix
+                + b', '.join(encoded_id for _, _, encoded_id in self.clients.values())
+            )
+        return self.users_frame
+
+    async def route_message(self, sender_id, recipient_id, message):
         """Маршрутизация сообщения к получателю"""
-        with self.lock:
-            if recipient_id in self.clients:
-                self.message_queues[recipient_id].put(f'Сообщение от {sender_id}: {message}')
-                self.message_queues[sender_id].put(f'Сообщение доставлено клиенту {recipient_id}')
-                logging.info(f'Сообщение от {sender_id} доставлено клиенту {recipient_id}')
-            else:
-                self.message_queues[sender_id].put(f'Ошибка: Клиент {recipient_id} не найден')
-                logging.warning(f'Попытка отправить сообщение несуществующему клиенту {recipient_id}')
+        sender = self.clients.get(sender_id)
+        if sender is None:
+            return
+
+        recipient = self.clients.get(recipient_id)
+        if recipient is None:
+            await self.send_message(sender_id, f'Ошибка: Клиент {recipient_id} не найден')
+            logging.warning('Попытка отправить сообщение несуществующему клиенту %s', recipient_id)
+            return
 
-    def send_messages(self, client_id):
-        """Отправка сообщений клиенту из его очереди"""
-        conn, _ = self.clients[client_id]
+        # Кадры собираются один раз из готовых байтов, без форматирования строк
+        message_frame = pack_frame(
+            self.message_prefix + sender[2] + b': ' + message
+        )
+        if self.deliver_frame(recipient_id, message_frame):
+            delivered_frame = pack_frame(self.delivered_prefix + recipient[2])
+            await self.send_frame(sender_id, delivered_frame)
+            logging.info('Сообщение от %s доставлено клиенту %s', sender_id, recipient_id)
+        else:
+            await self.send_message(sender_id, f'Ошибка: Сообщение не доставлено клиенту {recipient_id}')
+            logging.warning('Сообщение от %s не доставлено клиенту %s', sender_id, recipient_id)
+
+    @staticmethod
+    def encode_message(message):
+        """Кодирование текстового сообщения в кадр протокола"""
+        return pack_frame(message.encode('utf-8'))
+
+    async def send_message(self, client_id, message):
+        """Отправка текстового сообщения клиенту"""
+        await self.send_frame(client_id, self.encode_message(message))
 
+    async def send_frame(self, client_id, frame):
+        """Отправка готового кадра клиенту, чей обработчик выполняет вызов"""
+        client = self.clients.get(client_id)
+        if client is None:
+            return
+
+        writer = client[0]
         try:
-            while True:
-                message = self.message_queues[client_id].get()
-                conn.sendall(message.encode('utf-8'))
+            writer.write(frame)
+            await writer.drain()
         except (ConnectionResetError, BrokenPipeError):
             self.disconnect_client(client_id)
 
-    def disconnect_client(self, client_id):
-        """Отключение клиента и очистка ресурсов"""
-        with self.lock:
-            if client_id in self.clients:
-                conn, addr = self.clients.pop(client_id)
-                self.message_queues.pop(client_id)
-                conn.close()
-                logging.info(f'Клиент {addr} (ID: {client_id}) отключен')
-                print(f'Клиент {addr} (ID: {client_id}) отключен')
+    def deliver_frame(self, client_id, frame):
+        """
+        Передача кадра другому клиенту без ожидания отправки.
+        Обработчик отправителя не должен зависеть от того, читает ли получатель
+        свой сокет, поэтому drain() для чужого writer не вызывается. То, что
+        не удалось отправить сразу, остается в буфере транспорта; получатель,
+        у которого этот буфер превысил MAX_SEND_BUFFER, отключается сразу,
+        без отправки накопленных данных.
+        Возвращает False, если получатель отключен и кадр не будет доставлен
+        """
+        client = self.clients.get(client_id)
+        if client is None:
+            return False
+
+        writer = client[0]
+        writer.write(frame)
+        if writer.transport.get_write_buffer_size() > MAX_SEND_BUFFER:
+            logging.warning('Клиент %s не успевает принимать сообщения', client_id)
+            self.disconnect_client(client_id, abort=True)
+            return False
+        return True
+
+    def disconnect_client(self, client_id, abort=False):
+        """
+        Отключение клиента и очистка ресурсов.
+        close() дожидается отправки буфера, который клиент, не читающий сокет,
+        никогда не примет; abort=True закрывает соединение немедленно
+        """
+        if client_id in self.clients:
+            writer, addr, _ = self.clients.pop(client_id)
+            self.users_frame = None
+            if abort:
+                writer.transport.abort()
+            else:
+                writer.close()
+            logging.info('Клиент %s (ID: %s) отключен', addr, client_id)
+            print(f'Клиент {addr} (ID: {client_id}) отключен')
 
     def shutdown(self):
         """Корректное завершение работы сервера"""
-        with self.lock:
-            for client_id in list(self.clients.keys()):
-                self.disconnect_client(client_id)
-            self.server_socket.close()
-            logging.info('Сервер остановлен')
-            print('Сервер остановлен')
+        for client_id in list(self.clients.keys()):
+            self.disconnect_client(client_id)
+        self.server.close()
+        logging.info('Сервер остановлен')
+        print('Сервер остановлен')
+        self.log_listener.stop()
 
 
 if __name__ == '__main__':
     server = ChatServer()
-    server.start()
\ No newline at end of file
+    try:
+        asyncio.run(server.start())
+    except KeyboardInterrupt:
+        pass
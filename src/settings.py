@@ -5,4 +5,23 @@ ALLOWED_COMMANDS = [
     '/exit',
     '/quit',
     '/help',
-]
\ No newline at end of file
+]
+
+# Длина очереди входящих подключений. Event loop принимает до этого числа
+# подключений за одно пробуждение, поэтому значение задает размер пачки accept
+LISTEN_BACKLOG = 100
+
+# Максимальный размер сообщения клиента в байтах
+MAX_MESSAGE_SIZE = 4096
+
+# Предел неотправленных данных клиента в байтах. Кадры для клиента, который
+# не читает свой сокет, копятся в буфере транспорта; при превышении предела
+# клиент отключается
+MAX_SEND_BUFFER = 1024 * 1024
+
+# Максимальное число одновременно подключенных клиентов. Сверх него
+# сервер отвечает ошибкой и сразу закрывает соединение
+MAX_CLIENTS = 1000
+
+# Время ожидания подключения клиента к одному адресу сервера, в секундах
+CONNECT_TIMEOUT = 3